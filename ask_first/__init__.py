@@ -10,27 +10,55 @@ from __future__ import print_function, division
 
 import argparse
 import collections
-import json
+import concurrent.futures
+import functools
+import itertools
 import logging
+import math
 import os
+import pickle
+import re
 import subprocess
-import tempfile
 import warnings
 
 import astropy.coordinates
-import astropy.io.ascii
 import astropy.io.fits
 import astropy.wcs
 import numpy
 import pandas
-import scipy.spatial.distance
+import scipy.spatial
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
 
 logger = logging.getLogger(__name__)
 
+# Parsed centres files, keyed by (path, modification time).
+_CENTRES_CACHE = {}
+
+# Number of fields to read ahead in get_images.
+_PREFETCH_FIELDS = 4
+# Header cards that describe the source array rather than the sky, so
+# don't carry over to a cutout. BSCALE and BZERO go too, since cutouts
+# are already scaled, and DATAMIN and DATAMAX no longer hold.
+_ARRAY_KEYWORDS = {
+    'SIMPLE', 'BITPIX', 'EXTEND', 'BLOCKED', 'BSCALE', 'BZERO',
+    'DATAMIN', 'DATAMAX', 'LONPOLE', 'LATPOLE', 'WCSAXES', 'EQUINOX',
+    'RADESYS', 'EPOCH',
+}
+_FITS_STRING = re.compile(r"^'((?:[^']|'')*)'")
+_WCS_KEYWORD = re.compile(
+    r'^(NAXIS|CTYPE|CRVAL|CDELT|CRPIX|CROTA|CUNIT)\d*$|^(PC|CD|PV)\d+_\d+$')
+
 
 def make_image_table(first_path, image_table_path):
     """Generates an image metadata table if it doesn't exist.
 
+    .. deprecated::
+        get_image no longer uses Montage, so it doesn't need this table.
+
     Parameters
     ----------
     first_path : str
@@ -39,6 +67,9 @@ def make_image_table(first_path, image_table_path):
     image_table_path : str
         Path to write image metadata table.
     """
+    warnings.warn(
+        'make_image_table is deprecated, since get_image no longer uses '
+        'Montage.', DeprecationWarning, stacklevel=2)
     if not os.path.exists(image_table_path):
         subprocess.run([
             'mImgtbl',
@@ -49,8 +80,752 @@ def make_image_table(first_path, image_table_path):
         ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
-def get_image(coord, width, first_path, image_table_path,
-              fits=False):
+def _unit_vectors(coords):
+    """Convert sky coordinates to unit vectors.
+
+    Straight-line distances between unit vectors increase with distance on
+    the sky, unlike distances between (RA, dec) pairs, which are wrong
+    across RA = 0 and away from the equator.
+
+    Parameters
+    ----------
+    coords : array_like
+        N x 2 array of coordinates (RA, dec) in degrees.
+
+    Returns
+    -------
+    numpy.ndarray
+        N x 3 array of unit vectors.
+    """
+    coords = numpy.radians(numpy.asarray(coords, dtype=numpy.float64))
+    ra = coords[..., 0]
+    dec = coords[..., 1]
+    return numpy.stack([numpy.cos(dec) * numpy.cos(ra),
+                        numpy.cos(dec) * numpy.sin(ra),
+                        numpy.sin(dec)], axis=-1)
+
+
+class PathIndex(object):
+    """Spatial index mapping FIRST field centres to image paths.
+
+    Parameters
+    ----------
+    centres : array_like
+        N x 2 array of field centres (RA, dec).
+
+    paths : [str]
+        Paths of FITS images of each field, in the same order as centres.
+
+    first_path : str
+        Path to FIRST data that was indexed, if known.
+
+    tree : scipy.spatial.cKDTree
+        k-d tree over the unit vectors of centres. Built from centres if not
+        given.
+
+    Attributes
+    ----------
+    centres : numpy.ndarray
+        N x 2 array of field centres (RA, dec).
+
+    paths : [str]
+        Paths of FITS images of each field.
+
+    first_path : str
+        Path to FIRST data that was indexed, if known.
+
+    tree : scipy.spatial.cKDTree
+        k-d tree over the unit vectors of centres.
+    """
+
+    def __init__(self, centres, paths, first_path=None, tree=None):
+        self.centres = numpy.asarray(
+            centres, dtype=numpy.float64).reshape(-1, 2)
+        self.paths = paths
+        self.first_path = first_path
+        if len(self.centres) != len(self.paths):
+            raise ValueError('Got {} centres but {} paths'.format(
+                len(self.centres), len(self.paths)))
+
+        if tree is None:
+            tree = scipy.spatial.cKDTree(
+                _unit_vectors(self.centres), leafsize=32,
+                balanced_tree=False, compact_nodes=False, copy_data=False)
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.paths)
+
+    def closest(self, coord):
+        """Find the field centre closest to a coordinate.
+
+        Parameters
+        ----------
+        coord : (float, float)
+            Coordinate (RA, dec).
+
+        Returns
+        -------
+        int
+            Index of closest field centre.
+        """
+        _, i = self.tree.query(_unit_vectors(coord), k=1)
+        return i
+
+    def closest_all(self, coords):
+        """Find the field centres closest to many coordinates.
+
+        Parameters
+        ----------
+        coords : array_like
+            N x 2 array of coordinates (RA, dec).
+
+        Returns
+        -------
+        numpy.ndarray
+            Indices of closest field centres.
+        """
+        # A scalar k gives an (N,) array of indices rather than (N, 1), and
+        # the query runs in parallel.
+        _, i = self.tree.query(_unit_vectors(coords), k=1, workers=-1)
+        return i
+
+
+def _load_centres(centres_path):
+    """Load a centres file written by read_paths, with caching.
+
+    A centres file is a NumPy .npy file holding the field centres, which is
+    memory-mapped on load. Alongside it are a text file
+    centres_path + '.paths', holding the indexed FIRST path and then one
+    image path per field centre, and a pickled k-d tree
+    centres_path + '.tree'.
+
+    Parameters
+    ----------
+    centres_path : str
+        Path to centres file.
+
+    Returns
+    -------
+    PathIndex
+    """
+    key = (centres_path, os.path.getmtime(centres_path))
+    index = _CENTRES_CACHE.get(key)
+    if index is None:
+        centres = numpy.load(centres_path, mmap_mode='r')
+        with open(centres_path + '.paths') as f:
+            first_path, *paths = f.read().split('\n')
+        try:
+            with open(centres_path + '.tree', 'rb') as f:
+                tree = pickle.load(f)
+        except FileNotFoundError:
+            tree = None
+        if tree is not None and (
+                tree.n != len(centres) or
+                not numpy.array_equal(tree.data, _unit_vectors(centres))):
+            logger.debug('Rebuilding stale k-d tree for %s.', centres_path)
+            tree = None
+        index = PathIndex(centres, paths, first_path=first_path or None,
+                          tree=tree)
+        # Drop indices from older versions of this file.
+        for stale_key in [k for k in _CENTRES_CACHE if k[0] == centres_path]:
+            del _CENTRES_CACHE[stale_key]
+        _CENTRES_CACHE[key] = index
+    return index
+
+
+def _write_centres(index, centres_path):
+    """Write a centres file that can be read by _load_centres.
+
+    Parameters
+    ----------
+    index : PathIndex
+        Index to write.
+
+    centres_path : str
+        Path to write centres file.
+    """
+    with open(centres_path + '.paths', 'w') as f:
+        f.write('\n'.join([index.first_path or ''] + index.paths))
+    with open(centres_path + '.tree', 'wb') as f:
+        pickle.dump(index.tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Pass a file object so that NumPy doesn't append .npy to the path.
+    # Write to a new file and swap it in: truncating the old one would
+    # break any index still memory-mapping it.
+    with open(centres_path + '.tmp', 'wb') as f:
+        numpy.save(f, index.centres)
+    os.replace(centres_path + '.tmp', centres_path)
+
+
+def _scan_dir(path):
+    """List the subdirectories and FITS files in a directory.
+
+    Parameters
+    ----------
+    path : str
+        Path to directory.
+
+    Returns
+    -------
+    ([str], [(str, str)])
+        Paths of subdirectories, and path and filename of each FITS file.
+        Both are empty if the directory can't be read.
+    """
+    subdirs = []
+    fits_files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif (entry.name.endswith('.fits') and
+                        not entry.name.startswith('.')):
+                    fits_files.append((entry.path, entry.name))
+    except OSError as e:
+        # Skip unreadable directories, like os.walk.
+        logger.debug('Skipping %s: %s', path, e)
+        return [], []
+    return subdirs, fits_files
+
+
+def _iter_fits(first_path, max_workers=32):
+    """Find FITS files in a directory tree.
+
+    Directories are scanned concurrently, since scanning is bound by
+    filesystem latency rather than CPU.
+
+    Parameters
+    ----------
+    first_path : str
+        Path to FIRST data.
+
+    max_workers : int
+        Maximum number of directories to scan at once.
+
+    Yields
+    ------
+    (str, str)
+        Path and filename of each FITS file.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as pool:
+        pending = {pool.submit(_scan_dir, first_path)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                subdirs, fits_files = future.result()
+                pending.update(pool.submit(_scan_dir, subdir)
+                               for subdir in subdirs)
+                for fits_file in fits_files:
+                    yield fits_file
+
+
+def _decode_centres(filenames):
+    """Decode field centres from FIRST image filenames.
+
+    Parameters
+    ----------
+    filenames : [str]
+        FIRST image filenames, HHMMM+DDMMMX.fits.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        RAs and decs of field centres in degrees, and a boolean mask of
+        which filenames are FIRST field names. RAs and decs of other
+        filenames are meaningless.
+    """
+    # View the first 11 characters of each filename as a row of bytes.
+    # NumPy truncates and encodes the filenames without a Python loop, but
+    # only ASCII encodes, so blank out other names: they can't be FIRST
+    # field names and blanks decode as invalid.
+    filenames = [name if name.isascii() else '' for name in filenames]
+    chars = numpy.array(filenames, dtype='S11').view(numpy.uint8).reshape(
+        len(filenames), 11)
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    valid = (is_digit[:, :5].all(axis=1) & is_digit[:, 6:].all(axis=1) &
+             ((chars[:, 5] == ord('+')) | (chars[:, 5] == ord('-'))))
+    digits = chars.astype(numpy.float64) - ord('0')
+    ras = (digits[:, 0] * 10 + digits[:, 1] +
+           (digits[:, 2] * 10 + digits[:, 3]) / 60 +
+           digits[:, 4] / 600) * 15
+    signs = numpy.where(chars[:, 5] == ord('-'), -1, 1)
+    decs = signs * (digits[:, 6] * 10 + digits[:, 7] +
+                    (digits[:, 8] * 10 + digits[:, 9]) / 60 +
+                    digits[:, 10] / 600)
+    return ras, decs, valid
+
+
+def read_paths(first_path, centres_path=None):
+    """Index the FIRST images in a directory.
+
+    FIRST images are named HHMMM+DDMMMX.fits, where HHMMM is the RA of the
+    field centre in hours and tenths of minutes, DDMMM is the declination
+    in degrees and tenths of arcminutes, and X is the epoch letter.
+
+    Parameters
+    ----------
+    first_path : str
+        Path to FIRST data.
+
+    centres_path : str
+        Path to a centres file caching the index. The index is read from
+        this file if it exists and was built from first_path, and written
+        to it otherwise.
+
+    Returns
+    -------
+    PathIndex
+    """
+    if centres_path is not None and os.path.exists(centres_path):
+        index = _load_centres(centres_path)
+        if index.first_path == first_path:
+            return index
+        logger.info('Rebuilding %s: it indexes %s, not %s.',
+                    centres_path, index.first_path, first_path)
+
+    filenames = []
+    filepaths = []
+    for filepath, filename in _iter_fits(first_path):
+        filenames.append(filename)
+        filepaths.append(filepath)
+
+    ras, decs, valid = _decode_centres(filenames)
+    for i in numpy.flatnonzero(~valid).tolist():
+        logger.debug('Skipping %s: not a FIRST image.', filepaths[i])
+    valid_indices = numpy.flatnonzero(valid)
+
+    # Map each centre to the index of its image file.
+    centre_to_index = {}
+    for i, centre in zip(valid_indices.tolist(), zip(
+            ras[valid_indices].tolist(), decs[valid_indices].tolist())):
+        # Use the smallest available epoch letter.
+        j = centre_to_index.setdefault(centre, i)
+        if filenames[i] < filenames[j]:
+            centre_to_index[centre] = i
+
+    logger.debug('Found %d FIRST fields.', len(centre_to_index))
+    indices = numpy.fromiter(
+        centre_to_index.values(), dtype=numpy.intp,
+        count=len(centre_to_index))
+    index = PathIndex(
+        numpy.column_stack([ras[indices], decs[indices]]),
+        [filepaths[i] for i in indices.tolist()],
+        first_path=first_path)
+    if centres_path is not None:
+        _write_centres(index, centres_path)
+    return index
+
+
+# An open FIRST image. pixels is sliced like a 4D array and bscale and bzero
+# are applied to its values. shape is the (height, width) of the image in
+# pixels. Pixel coordinates come from projection if the image has a simple
+# zenithal projection, and from wcs otherwise.
+_Field = collections.namedtuple(
+    '_Field', ['pixels', 'shape', 'projection', 'wcs', 'bscale', 'bzero'])
+
+# An unrotated SIN or TAN projection.
+_Projection = collections.namedtuple(
+    '_Projection',
+    ['code', 'crval1', 'crval2', 'crpix1', 'crpix2', 'cdelt1', 'cdelt2'])
+
+
+def _read_projection(header):
+    """Read a simple zenithal projection from a FITS header.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header | fitsio.FITSHDR
+        Header of FIRST image.
+
+    Returns
+    -------
+    _Projection | None
+        Projection, or None if the projection needs the full WCS.
+    """
+    code = header.get('CTYPE1', '')[4:]
+    if (code not in {'-SIN', '-TAN'} or
+            not header.get('CTYPE1', '').startswith('RA') or
+            header.get('CTYPE2', '') != 'DEC-' + code or
+            header.get('CROTA2', 0) != 0 or
+            header.get('LONPOLE', 180) != 180 or
+            any(header.get(k, 0) != 0 for k in ['PV2_1', 'PV2_2'])):
+        return None
+
+    for matrix in ['CD', 'PC']:
+        for i, j in itertools.product([1, 2], repeat=2):
+            if '{}{}_{}'.format(matrix, i, j) in header:
+                return None
+
+    return _Projection(
+        code, *(float(header[k]) for k in [
+            'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2']))
+
+
+def _world2pix(projection, ra, dec):
+    """Convert sky coordinates to pixels with a simple zenithal projection.
+
+    Parameters
+    ----------
+    projection : _Projection
+        Projection of FIRST image.
+
+    ra, dec : float
+        Sky coordinate in degrees.
+
+    Returns
+    -------
+    (float, float)
+        Zero-based pixel coordinate (x, y).
+    """
+    ra0 = math.radians(projection.crval1)
+    dec0 = math.radians(projection.crval2)
+    ra = math.radians(ra)
+    dec = math.radians(dec)
+    # Standard coordinates relative to the reference point.
+    xi = math.cos(dec) * math.sin(ra - ra0)
+    eta = (math.sin(dec) * math.cos(dec0) -
+           math.cos(dec) * math.sin(dec0) * math.cos(ra - ra0))
+    if projection.code == '-TAN':
+        cos_dist = (math.sin(dec) * math.sin(dec0) +
+                    math.cos(dec) * math.cos(dec0) * math.cos(ra - ra0))
+        xi /= cos_dist
+        eta /= cos_dist
+    x = projection.crpix1 - 1 + math.degrees(xi) / projection.cdelt1
+    y = projection.crpix2 - 1 + math.degrees(eta) / projection.cdelt2
+    return x, y
+
+
+@functools.lru_cache(maxsize=64)
+def _open_field(path):
+    """Open a FIRST image for taking cutouts.
+
+    Up to 64 images are kept open, so repeated cutouts of an image don't
+    reopen it or reparse its header and WCS.
+
+    Parameters
+    ----------
+    path : str
+        Path to FIRST image.
+
+    Returns
+    -------
+    _Field
+    """
+    with warnings.catch_warnings():
+        # FIRST headers are old and astropy.wcs complains about them.
+        warnings.simplefilter('ignore')
+        if fitsio is not None:
+            hdu = fitsio.FITS(path)[0]
+            header = hdu.read_header()
+            projection = _read_projection(header)
+            if projection is None:
+                header = astropy.io.fits.Header.fromstring(''.join(
+                    card['card_string'].ljust(80)
+                    for card in header.records()))
+            # cfitsio scales pixels as it reads them.
+            bscale, bzero = 1, 0
+            pixels = hdu
+            shape = tuple(hdu.get_dims()[-2:])
+        else:
+            # Scale only cutouts rather than the whole image.
+            fits = astropy.io.fits.open(
+                path, memmap=True, do_not_scale_image_data=True,
+                lazy_load_hdus=True)
+            header = fits[0].header
+            projection = _read_projection(header)
+            bscale = header.get('BSCALE', 1)
+            bzero = header.get('BZERO', 0)
+            # Only read the pixels in each cutout.
+            pixels = fits[0].section
+            shape = header['NAXIS2'], header['NAXIS1']
+        wcs = None
+        if projection is None:
+            # Drop the frequency and Stokes axes.
+            wcs = astropy.wcs.WCS(header).dropaxis(3).dropaxis(2)
+    return _Field(pixels, shape, projection, wcs, bscale, bzero)
+
+
+def _pixel_bounds(field, coord, width):
+    """Find the pixel bounds of a square cutout of a FIRST image.
+
+    Parameters
+    ----------
+    field : _Field
+        FIRST image, as returned by _open_field.
+
+    coord : (float, float)
+        Centre of cutout (RA, dec).
+
+    width : float
+        Width in degrees.
+
+    Returns
+    -------
+    (int, int, int, int)
+        Start and stop x, then start and stop y of the cutout in pixels,
+        clipped to the image.
+    """
+    ra, dec = coord
+    half_height = width / 2
+    half_width = half_height / math.cos(math.radians(dec))
+    corners = [[ra + half_width, dec - half_height],
+               [ra - half_width, dec + half_height]]
+    if field.projection is not None:
+        (x0, y0), (x1, y1) = (
+            _world2pix(field.projection, *corner) for corner in corners)
+    else:
+        (x0, y0), (x1, y1) = field.wcs.all_world2pix(corners, 0)
+    # The corners can be in either order depending on the signs of CDELT.
+    min_x, max_x = sorted((x0, x1))
+    min_y, max_y = sorted((y0, y1))
+    height, width = field.shape
+    return (min(max(int(min_x), 0), width),
+            min(max(int(max_x) + 1, 0), width),
+            min(max(int(min_y), 0), height),
+            min(max(int(max_y) + 1, 0), height))
+
+
+def _parse_hms_dms(coord):
+    """Parse a "HH MM SS.S +DD MM SS.S" coordinate.
+
+    Parameters
+    ----------
+    coord : str
+        Coordinate.
+
+    Returns
+    -------
+    (float, float)
+        RA and dec in degrees.
+
+    Raises
+    ------
+    ValueError
+        If the coordinate is not in this format or is out of range.
+    """
+    parts = coord.split()
+    if len(parts) != 6:
+        raise ValueError('Expected 6 components, got {}'.format(len(parts)))
+
+    hours, ra_minutes, ra_seconds = (
+        int(parts[0]), int(parts[1]), float(parts[2]))
+    # Read the sign separately so that -00 is negative.
+    sign = -1 if parts[3].startswith('-') else 1
+    degrees, dec_minutes, dec_seconds = (
+        abs(int(parts[3])), int(parts[4]), float(parts[5]))
+    if not 0 <= hours < 24:
+        raise ValueError('RA hours out of range: {}'.format(parts[0]))
+    for part, value in [(parts[1], ra_minutes), (parts[2], ra_seconds),
+                        (parts[4], dec_minutes), (parts[5], dec_seconds)]:
+        if not 0 <= value < 60:
+            raise ValueError(
+                'Minutes or seconds out of range: {}'.format(part))
+
+    ra = (hours + ra_minutes / 60 + ra_seconds / 3600) * 15
+    dec = sign * (degrees + dec_minutes / 60 + dec_seconds / 3600)
+    if abs(dec) > 90:
+        raise ValueError('Dec out of range: {}'.format(dec))
+    return ra, dec
+
+
+def _parse_coord(coord):
+    """Parse a coordinate string.
+
+    Parameters
+    ----------
+    coord : str
+        Coordinate, with RA in hours and dec in degrees.
+
+    Returns
+    -------
+    (float, float)
+        RA and dec in degrees.
+    """
+    try:
+        return _parse_hms_dms(coord)
+    except ValueError:
+        # Fall back to astropy, which is slow but handles more formats.
+        coord = astropy.coordinates.SkyCoord(coord, unit=('hour', 'deg'))
+        return coord.ra.deg, coord.dec.deg
+
+
+def _read_pixels(field, bounds):
+    """Read a rectangle of pixels from a FIRST image.
+
+    Parameters
+    ----------
+    field : _Field
+        FIRST image, as returned by _open_field.
+
+    bounds : (int, int, int, int)
+        Pixel bounds, as returned by _pixel_bounds.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    min_x, max_x, min_y, max_y = bounds
+    if min_x == max_x or min_y == max_y:
+        # The cutout doesn't overlap the image.
+        return numpy.zeros((max_y - min_y, max_x - min_x))
+
+    patch = field.pixels[0:1, 0:1, min_y:max_y, min_x:max_x][0, 0]
+    return patch.astype(numpy.float64) * field.bscale + field.bzero
+
+
+def _cutout(field, coord, width):
+    """Cut out a square image from a FIRST image.
+
+    The cutout is clipped where it extends past the edge of the image.
+
+    Parameters
+    ----------
+    field : _Field
+        FIRST image, as returned by _open_field.
+
+    coord : (float, float)
+        Centre of cutout (RA, dec).
+
+    width : float
+        Width in degrees.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    return _read_pixels(field, _pixel_bounds(field, coord, width))
+
+
+def _cutout_hdus(path, bounds, patch):
+    """Wrap a cutout of a FIRST image in a FITS HDU list.
+
+    Parameters
+    ----------
+    path : str
+        Path to FIRST image.
+
+    bounds : (int, int, int, int)
+        Pixel bounds of the cutout, as returned by _pixel_bounds.
+
+    patch : numpy.ndarray
+        Cutout.
+
+    Returns
+    -------
+    astropy.io.fits.HDUList
+    """
+    min_x, max_x, min_y, max_y = bounds
+    source = astropy.io.fits.getheader(path)
+    with warnings.catch_warnings():
+        # FIRST headers are old and astropy.wcs complains about them.
+        warnings.simplefilter('ignore')
+        # Drop the frequency and Stokes axes.
+        wcs = astropy.wcs.WCS(source).dropaxis(3).dropaxis(2)
+        wcs_header = wcs[min_y:max_y, min_x:max_x].to_header()
+    # Keep the rest of the source header (BUNIT, the beam, history...),
+    # but not the cards describing the old array or its coordinates.
+    header = astropy.io.fits.Header([
+        card for card in source.cards
+        if not _WCS_KEYWORD.match(card.keyword)
+        and card.keyword not in _ARRAY_KEYWORDS])
+    header.update(wcs_header)
+    return astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(
+        patch, header=header)])
+
+
+def _read_header_values(f):
+    """Read the keyword values of a FITS header.
+
+    This is a minimal parser that, unlike astropy, doesn't warn, so it's
+    safe to call off the main thread. Only "KEYWORD = value" cards with
+    string, logical, integer or float values are read.
+
+    Parameters
+    ----------
+    f : file
+        FITS file open in binary mode at the start of a header. It's left
+        at the end of the header.
+
+    Returns
+    -------
+    dict
+        Map from keyword to value.
+    """
+    values = {}
+    while True:
+        block = f.read(2880)
+        if len(block) < 2880:
+            raise ValueError('Truncated FITS header')
+        for i in range(0, 2880, 80):
+            card = block[i:i + 80].decode('ascii', errors='replace')
+            keyword = card[:8].rstrip()
+            if keyword == 'END':
+                return values
+            if card[8:10] != '= ':
+                continue
+            value = card[10:].strip()
+            string = _FITS_STRING.match(value)
+            if string:
+                values[keyword] = (
+                    string.group(1).replace("''", "'").rstrip())
+                continue
+            value = value.split('/', 1)[0].strip()
+            if value in {'T', 'F'}:
+                values[keyword] = value == 'T'
+                continue
+            try:
+                values[keyword] = int(value)
+            except ValueError:
+                try:
+                    values[keyword] = float(value.replace('D', 'E'))
+                except ValueError:
+                    pass
+
+
+def _prefetch(path, coords, width):
+    """Ask the OS to start reading the parts of a FIRST image cutouts need.
+
+    The header is read directly. Only the rows that the cutouts cover are
+    read ahead, since a cutout is a small part of the image.
+
+    Parameters
+    ----------
+    path : str
+        Path to FIRST image.
+
+    coords : numpy.ndarray
+        N x 2 array of cutout centres (RA, dec).
+
+    width : float
+        Width of cutouts in degrees.
+    """
+    with open(path, 'rb') as f:
+        # This runs on a worker thread, where astropy's header parser and
+        # the warnings filters it needs aren't safe to use.
+        header = _read_header_values(f)
+        data_offset = f.tell()
+        projection = _read_projection(header)
+        if projection is None:
+            # Finding the rows needs the full WCS, so leave it to the reader.
+            return
+
+        field = _Field(None, (header['NAXIS2'], header['NAXIS1']),
+                       projection, None, 1, 0)
+        bounds = [_pixel_bounds(field, coord, width) for coord in coords]
+        min_y = min(b[2] for b in bounds)
+        max_y = max(b[3] for b in bounds)
+        if min_y == max_y:
+            return
+
+        row_bytes = header['NAXIS1'] * abs(header['BITPIX']) // 8
+        os.posix_fadvise(
+            f.fileno(), data_offset + min_y * row_bytes,
+            (max_y - min_y) * row_bytes, os.POSIX_FADV_WILLNEED)
+
+
+def get_image(coord, width, paths, fits=False):
     """Get an image from FIRST at a coordinate.
 
     Parameters
@@ -61,12 +836,9 @@ def get_image(coord, width, first_path, image_table_path,
     width : float
         Width in degrees.
 
-    first_path : str
-        Path to FIRST data.
-
-    image_table_path : str
-        Path to image metadata table. Will be created if it doesn't
-        already exist.
+    paths : PathIndex | str
+        Index of FIRST images, as returned by read_paths, or path to a
+        centres file written by read_paths.
 
     fits : bool
         Whether to return FITS instead of NumPy.
@@ -74,80 +846,83 @@ def get_image(coord, width, first_path, image_table_path,
     Returns
     -------
     numpy.ndarray or FITS
+        Image, clipped where it extends past the edge of the FIRST image.
     """
+    if isinstance(paths, str):
+        paths = _load_centres(paths)
+
+    if not len(paths):
+        raise ValueError('No FIRST images in index')
+
     if isinstance(coord, str):
-        coord = astropy.coordinates.SkyCoord(coord, unit=('hour', 'deg'))
-        coord = (coord.ra.deg, coord.dec.deg)
+        coord = _parse_coord(coord)
 
-    make_image_table(first_path, image_table_path)
+    path = paths.paths[paths.closest(coord)]
+    field = _open_field(path)
+    bounds = _pixel_bounds(field, coord, width)
+    patch = _read_pixels(field, bounds)
+    if not fits:
+        return patch
+    return _cutout_hdus(path, bounds, patch)
 
-    # Get coverage information.
-    with tempfile.NamedTemporaryFile() as coverage_file, \
-            tempfile.NamedTemporaryFile(delete=True) as out_file:
-            # tempfile.NamedTemporaryFile() as header_file, \
-        coverage_filename = coverage_file.name
-        out_filename = out_file.name
-        # header_filename = header_file.name
 
-        subprocess.run([
-            # For some reason mCoverageCheck fails unless it has two
-            # initial dummy arguments. These can be pretty much anything
-            # except -s and probably some other stuff but I've gone with 0
-            # and 0.
-            'mCoverageCheck', '0', '0',
-            image_table_path, coverage_filename, '-box',
-            str(coord[0]), str(coord[1]), str(width)],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # Confirm there's only one image containing this object
-        # (i.e. no mosaic required).
-        _coverage_data = coverage_file.read()
-
-        if not _coverage_data.count(b'\n') == 4:
-            logger.debug('More than one file in coverage')
-
-        # Get the source filename.
-        coverage_file.seek(0)
-        filenames = astropy.io.ascii.read(coverage_file)['fname']
-
-        for in_filename in filenames:
-            # Generate a cutout.
-            subprocess.run([
-                'mSubimage',
-                os.path.join(first_path, in_filename),
-                out_filename,
-                str(coord[0]), str(coord[1]), str(width)],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def get_images(coords, width, paths):
+    """Get images from FIRST at many coordinates.
 
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    if not fits:
-                        return astropy.io.fits.getdata(out_filename)
-                    return astropy.io.fits.open(out_filename)
-            except IOError:
-                continue
+    This is faster than calling get_image for each coordinate, since the
+    closest fields are found all at once and each field is opened once.
+
+    Parameters
+    ----------
+    coords : array_like
+        N x 2 array of image centres (RA, dec).
+
+    width : float
+        Width in degrees.
+
+    paths : PathIndex | str
+        Index of FIRST images, as returned by read_paths, or path to a
+        centres file written by read_paths.
 
-        raise IOError('Empty or corrupt fits files')
-
-        # TODO(MatthewJA): Add mosaicing.
-        # Here's the outline:
-        # # Coverage information is now stored in the coverage file.
-        # # Mosaic the images. First we make a FITS header.
-        # subprocess.run([
-        #     'mMakeHdr',
-        #     coverage_filename,
-        #     header_filename])
-
-        # # Then we can mosaic the images with this header as a template.
-        # subprocess.run([
-        #     'mAdd',
-        #     '-p', first_path,
-        #     '-a', 'mean',
-        #     coverage_filename,
-        #     header_filename,
-        #     out_filename])
-
-        # ...But this segfaults.
+    Returns
+    -------
+    [numpy.ndarray]
+        Images in the same order as coords, clipped where they extend past
+        the edge of their FIRST image.
+    """
+    if isinstance(paths, str):
+        paths = _load_centres(paths)
+
+    coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+    if not len(coords):
+        return []
+
+    if not len(paths):
+        raise ValueError('No FIRST images in index')
+
+    closest = paths.closest_all(coords)
+    images = [None] * len(coords)
+    # Group the queries by field.
+    order = numpy.argsort(closest, kind='stable')
+    starts = numpy.flatnonzero(numpy.diff(closest[order])) + 1
+    groups = numpy.split(order, starts)
+    field_paths = [paths.paths[closest[group[0]]] for group in groups]
+    prefetch = hasattr(os, 'posix_fadvise') and len(field_paths) > 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        if prefetch:
+            for path, group in zip(field_paths[:_PREFETCH_FIELDS],
+                                   groups[:_PREFETCH_FIELDS]):
+                pool.submit(_prefetch, path, coords[group], width)
+        for k, (path, group) in enumerate(zip(field_paths, groups)):
+            # Read upcoming fields from disk while we cut out this one.
+            ahead = k + _PREFETCH_FIELDS
+            if prefetch and ahead < len(field_paths):
+                pool.submit(_prefetch, field_paths[ahead],
+                            coords[groups[ahead]], width)
+            field = _open_field(path)
+            for j in group.tolist():
+                images[j] = _cutout(field, coords[j], width)
+    return images
 
 
 def read_catalogue(catalogue_path):
@@ -57,18 +57,16 @@ def main(step=2):
     for centre, centre_str in centres:
         # This fakes the epoch multiplicity.
         epochs = [random.choice(string.ascii_uppercase) for _ in range(4)]
-        path = [os.path.join(DATA_PATH, centre_str[:5],
-                             '{}{}.fits'.format(centre_str, epoch))
-                for epoch in epochs]
+        path = min(os.path.join(DATA_PATH, centre_str[:5],
+                                '{}{}.fits'.format(centre_str, epoch))
+                   for epoch in epochs)
         paths[centre] = path
     logger.debug('Generated paths.')
     # Now ensure that the real path is included.
-    paths[162.75, 30.759999999999998] = [
-        os.path.join(DATA_PATH, '10510', p) for p in [
-            '10510+30456E.fits',
-            '10510+30456F.fits',
-            '10510+30456S.fits',
-            '10510+30456T.fits']]
+    paths[162.75, 30.759999999999998] = os.path.join(
+        DATA_PATH, '10510', '10510+30456E.fits')
+    paths = ask_first.PathIndex(list(paths.keys()), list(paths.values()))
+    logger.debug('Built path index.')
     # Benchmarking: Query the test image 1000 times.
     logger.info('Beginning benchmarking with %d centres.', len(centres))
     coords = 162.5302917, 30.6770889
@@ -8,9 +8,16 @@ The Australian National University
 
 from __future__ import print_function, division
 
+import os
 import os.path
+import pickle
+import shutil
+import tempfile
 import unittest
+import unittest.mock
 
+import astropy.io.fits
+import astropy.wcs
 import numpy
 
 import ask_first
@@ -22,30 +29,283 @@ THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(THIS_DIR, 'data')
 
 
+class TestReadPaths(unittest.TestCase):
+
+    def test(self):
+        """read_paths finds FIRST images."""
+        paths = ask_first.read_paths(DATA_PATH)
+        self.assertEqual(len(paths), 1)
+        (ra, dec), = paths.centres
+        self.assertAlmostEqual(ra, 162.75)
+        self.assertAlmostEqual(dec, 30.76)
+        self.assertEqual(paths.paths, [
+            os.path.join(DATA_PATH, '10510', '10510+30456E.fits')])
+
+    def test_stray_fits(self):
+        """read_paths skips FITS files not named like FIRST fields."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copytree(os.path.join(DATA_PATH, '10510'),
+                        os.path.join(tempdir, '10510'))
+        for name in ['mosaic.fits', 'a.fits', '10510x30456E.fits',
+                     'résumé.fits']:
+            open(os.path.join(tempdir, name), 'w').close()
+
+        paths = ask_first.read_paths(tempdir)
+
+        self.assertEqual(paths.paths, [
+            os.path.join(tempdir, '10510', '10510+30456E.fits')])
+
+    def test_epoch(self):
+        """read_paths chooses the smallest epoch letter."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        source = os.path.join(DATA_PATH, '10510', '10510+30456E.fits')
+        for directory, name in [('a', '10510+30456E.fits'),
+                                ('b', '10510+30456C.fits'),
+                                ('c', '10510+30456D.fits')]:
+            os.mkdir(os.path.join(tempdir, directory))
+            shutil.copy(source, os.path.join(tempdir, directory, name))
+
+        paths = ask_first.read_paths(tempdir)
+
+        self.assertEqual(paths.paths, [
+            os.path.join(tempdir, 'b', '10510+30456C.fits')])
+
+    def test_unreadable_dir(self):
+        """read_paths skips directories it can't read."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copytree(os.path.join(DATA_PATH, '10510'),
+                        os.path.join(tempdir, '10510'))
+        unreadable = os.path.join(tempdir, '10520')
+        os.mkdir(unreadable)
+        scandir = os.scandir
+
+        def fake_scandir(path):
+            if path == unreadable:
+                raise PermissionError(path)
+            return scandir(path)
+
+        with unittest.mock.patch('os.scandir', fake_scandir):
+            paths = ask_first.read_paths(tempdir)
+
+        self.assertEqual(paths.paths, [
+            os.path.join(tempdir, '10510', '10510+30456E.fits')])
+
+    def test_missing_dir(self):
+        """read_paths finds nothing in a directory that doesn't exist."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        paths = ask_first.read_paths(os.path.join(tempdir, 'missing'))
+        self.assertEqual(len(paths), 0)
+
+    def test_centres_path(self):
+        """read_paths caches the index in a centres file."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        centres_path = os.path.join(tempdir, 'centres')
+        paths = ask_first.read_paths(DATA_PATH, centres_path)
+        self.assertTrue(os.path.exists(centres_path))
+        loaded = ask_first.read_paths(DATA_PATH, centres_path)
+        numpy.testing.assert_array_equal(loaded.centres, paths.centres)
+        self.assertEqual(loaded.paths, paths.paths)
+        self.assertEqual(loaded.first_path, DATA_PATH)
+
+    def test_centres_path_other_dir(self):
+        """read_paths rebuilds a centres file made for another directory."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copytree(os.path.join(DATA_PATH, '10510'),
+                        os.path.join(tempdir, 'first', '10510'))
+        first_path = os.path.join(tempdir, 'first')
+        centres_path = os.path.join(tempdir, 'centres')
+        ask_first.read_paths(DATA_PATH, centres_path)
+        paths = ask_first.read_paths(first_path, centres_path)
+        self.assertEqual(paths.first_path, first_path)
+        self.assertEqual(paths.paths, [
+            os.path.join(first_path, '10510', '10510+30456E.fits')])
+        # The rebuilt index replaces the old one on disk.
+        loaded = ask_first.read_paths(first_path, centres_path)
+        self.assertEqual(loaded.paths, paths.paths)
+
+
+class TestPathIndex(unittest.TestCase):
+
+    def test_ra_wrap(self):
+        """PathIndex finds the closest field across RA = 0."""
+        paths = ask_first.PathIndex([(0.1, 0), (359.0, 0)],
+                                    ['a.fits', 'b.fits'])
+        self.assertEqual(paths.closest((359.95, 0)), 0)
+        numpy.testing.assert_array_equal(
+            paths.closest_all([(359.95, 0), (0.5, 0), (358.9, 0)]),
+            [0, 0, 1])
+
+    def test_high_dec(self):
+        """PathIndex finds the closest field on the sky away from dec 0."""
+        # RA differences shrink by cos(dec) on the sky.
+        paths = ask_first.PathIndex([(10.45, 56), (10, 56.31)],
+                                    ['a.fits', 'b.fits'])
+        self.assertEqual(paths.closest((10, 56)), 0)
+
+
+class TestLoadCentres(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.centres_path = os.path.join(self.tempdir, 'centres')
+
+    def write(self, index, mtime):
+        ask_first._write_centres(index, self.centres_path)
+        os.utime(self.centres_path, (mtime, mtime))
+
+    def test_stale_tree(self):
+        """_load_centres rebuilds a k-d tree that doesn't match."""
+        index = ask_first.PathIndex(
+            [(1.0, 1.0), (2.0, 2.0)], ['a.fits', 'b.fits'])
+        self.write(index, 1)
+        other = ask_first.PathIndex([(2.0, 2.0), (1.0, 1.0), (3.0, 3.0)],
+                                    ['b.fits', 'a.fits', 'c.fits'])
+        with open(self.centres_path + '.tree', 'wb') as f:
+            pickle.dump(other.tree, f)
+
+        loaded = ask_first._load_centres(self.centres_path)
+
+        self.assertEqual(loaded.tree.n, 2)
+        self.assertEqual(loaded.paths[loaded.closest((1.1, 1.1))], 'a.fits')
+
+    def test_cache(self):
+        """_load_centres keeps only the newest version of a file."""
+        self.write(ask_first.PathIndex([(1.0, 1.0)], ['a.fits']), 1)
+        ask_first._load_centres(self.centres_path)
+        self.write(ask_first.PathIndex([(2.0, 2.0)], ['b.fits']), 2)
+
+        loaded = ask_first._load_centres(self.centres_path)
+
+        self.assertEqual(loaded.paths, ['b.fits'])
+        self.assertEqual(
+            [key for key in ask_first._CENTRES_CACHE
+             if key[0] == self.centres_path],
+            [(self.centres_path, 2)])
+
+
 class TestGetImage(unittest.TestCase):
 
+    def setUp(self):
+        self.paths = ask_first.read_paths(DATA_PATH)
+        ask_first._open_field.cache_clear()
+
     def test(self):
         """get_image retrieves an image."""
         # These coordinates are the defaults for the FIRST cutout server.
         coords = 162.5302917, 30.6770889
         width = 3 / 60
 
-        im = ask_first.get_image(
-            coords, width, DATA_PATH, os.path.join(DATA_PATH, 'img.tbl'))
+        im = ask_first.get_image(coords, width, self.paths)
+
+        reference_im = numpy.load(os.path.join(
+            DATA_PATH,
+            'test_data_162.5302917_30.6770889.npy'))
+        numpy.testing.assert_allclose(reference_im, im)
+
+    def test_astropy(self):
+        """get_image retrieves an image without fitsio."""
+        coords = 162.5302917, 30.6770889
+        width = 3 / 60
+
+        with unittest.mock.patch.object(ask_first, 'fitsio', None):
+            im = ask_first.get_image(coords, width, self.paths)
+
+        reference_im = numpy.load(os.path.join(
+            DATA_PATH,
+            'test_data_162.5302917_30.6770889.npy'))
+        numpy.testing.assert_allclose(reference_im, im)
+
+    def test_wcs(self):
+        """get_image retrieves an image using the full WCS."""
+        coords = 162.5302917, 30.6770889
+        width = 3 / 60
+
+        with unittest.mock.patch.object(
+                ask_first, '_read_projection', return_value=None):
+            im = ask_first.get_image(coords, width, self.paths)
+
+        reference_im = numpy.load(os.path.join(
+            DATA_PATH,
+            'test_data_162.5302917_30.6770889.npy'))
+        numpy.testing.assert_allclose(reference_im, im)
+
+    def test_centres_path(self):
+        """get_image retrieves an image given a centres file."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        centres_path = os.path.join(tempdir, 'centres')
+        ask_first.read_paths(DATA_PATH, centres_path)
+        coords = 162.5302917, 30.6770889
+        width = 3 / 60
+
+        im = ask_first.get_image(coords, width, centres_path)
 
         reference_im = numpy.load(os.path.join(
             DATA_PATH,
             'test_data_162.5302917_30.6770889.npy'))
         numpy.testing.assert_allclose(reference_im, im)
 
+    def test_edge(self):
+        """get_image clips images at the edge of a field."""
+        width = 3 / 60
+        for coords, shape in [((162.75, 30.48), (65, 101)),
+                              ((163.19, 30.76), (101, 68))]:
+            im = ask_first.get_image(coords, width, self.paths)
+            self.assertEqual(im.shape, shape)
+
+            ask_first._open_field.cache_clear()
+            with unittest.mock.patch.object(ask_first, 'fitsio', None):
+                astropy_im = ask_first.get_image(coords, width, self.paths)
+            ask_first._open_field.cache_clear()
+            numpy.testing.assert_array_equal(im, astropy_im)
+
+    def test_outside(self):
+        """get_image returns an empty image outside a field."""
+        im = ask_first.get_image((162.75, 31.5), 3 / 60, self.paths)
+        self.assertEqual(im.size, 0)
+
+    def test_empty_index(self):
+        """get_image raises ValueError given an empty index."""
+        paths = ask_first.PathIndex(numpy.zeros((0, 2)), [])
+        with self.assertRaises(ValueError):
+            ask_first.get_image((162.75, 30.76), 3 / 60, paths)
+
+    def test_fits(self):
+        """get_image retrieves a FITS image."""
+        coords = 162.5302917, 30.6770889
+        width = 3 / 60
+
+        fits = ask_first.get_image(coords, width, self.paths, fits=True)
+
+        reference_im = numpy.load(os.path.join(
+            DATA_PATH,
+            'test_data_162.5302917_30.6770889.npy'))
+        numpy.testing.assert_allclose(reference_im, fits[0].data)
+        wcs = astropy.wcs.WCS(fits[0].header)
+        (x, y), = wcs.all_world2pix([coords], 0)
+        self.assertAlmostEqual(x, 50, delta=1)
+        self.assertAlmostEqual(y, 50, delta=1)
+        # Non-WCS cards carry over from the FIRST header.
+        self.assertEqual(fits[0].header['BUNIT'].strip(), 'JY/BEAM')
+        self.assertAlmostEqual(fits[0].header['BMAJ'], 1.5e-3)
+        self.assertEqual(fits[0].header['NAXIS'], 2)
+        self.assertNotIn('CTYPE3', fits[0].header)
+        self.assertNotIn('BSCALE', fits[0].header)
+
     def test_str_coord(self):
         """get_image retrieves an image when given str coords."""
         # These coordinates are the defaults for the FIRST cutout server.
         coords = '10 50 07.270 +30 40 37.52'
         width = 3 / 60
 
-        im = ask_first.get_image(
-            coords, width, DATA_PATH, os.path.join(DATA_PATH, 'img.tbl'))
+        im = ask_first.get_image(coords, width, self.paths)
 
         reference_im = numpy.load(os.path.join(
             DATA_PATH,
@@ -53,6 +313,187 @@ class TestGetImage(unittest.TestCase):
         numpy.testing.assert_allclose(reference_im, im)
 
 
+class TestParseHmsDms(unittest.TestCase):
+
+    def test(self):
+        """_parse_hms_dms parses sexagesimal coordinates."""
+        ra, dec = ask_first._parse_hms_dms('10 50 07.270 +30 40 37.52')
+        self.assertAlmostEqual(ra, 162.5302917, places=6)
+        self.assertAlmostEqual(dec, 30.6770889, places=6)
+
+    def test_negative_zero(self):
+        """_parse_hms_dms keeps the sign of a -00 dec."""
+        ra, dec = ask_first._parse_hms_dms('00 00 00 -00 30 00')
+        self.assertEqual(ra, 0)
+        self.assertAlmostEqual(dec, -0.5)
+
+    def test_out_of_range(self):
+        """_parse_hms_dms rejects out-of-range components."""
+        for coord in ['25 00 00 +95 00 00', '10 75 07.270 +30 40 37.52',
+                      '10 50 60 +30 40 37.52', '10 50 07.270 +30 60 37.52',
+                      '10 50 07.270 +30 40 60', '10 50 07.270 +90 00 01',
+                      '10 50 07.270 -91 00 00', '-01 50 07.270 +30 40 37.52']:
+            with self.assertRaises(ValueError):
+                ask_first._parse_hms_dms(coord)
+
+    def test_components(self):
+        """_parse_hms_dms rejects the wrong number of components."""
+        with self.assertRaises(ValueError):
+            ask_first._parse_hms_dms('10 50 07.270 +30 40')
+
+
+class TestWorld2Pix(unittest.TestCase):
+
+    def check(self, code):
+        header = astropy.io.fits.Header()
+        header['NAXIS'] = 2
+        header['CTYPE1'] = 'RA--' + code
+        header['CTYPE2'] = 'DEC-' + code
+        header['CRVAL1'] = 162.75
+        header['CRVAL2'] = 30.76
+        header['CRPIX1'] = 774.2628174
+        header['CRPIX2'] = 575.789917
+        header['CDELT1'] = -5.000000237E-04
+        header['CDELT2'] = 5.000000237E-04
+        projection = ask_first._read_projection(header)
+        self.assertEqual(projection.code, code)
+        wcs = astropy.wcs.WCS(header)
+
+        coords = [(162.75, 30.76), (162.5302917, 30.6770889),
+                  (163.2, 30.4), (162.3, 31.1), (162.75, 31.0)]
+        expected = wcs.all_world2pix(coords, 0)
+        actual = [ask_first._world2pix(projection, ra, dec)
+                  for ra, dec in coords]
+        numpy.testing.assert_allclose(actual, expected, rtol=0, atol=1e-8)
+
+    def test_sin(self):
+        """_world2pix agrees with astropy.wcs for SIN projections."""
+        self.check('-SIN')
+
+    def test_tan(self):
+        """_world2pix agrees with astropy.wcs for TAN projections."""
+        self.check('-TAN')
+
+
+class TestPixelBounds(unittest.TestCase):
+
+    def test_flipped(self):
+        """_pixel_bounds orders bounds whatever the signs of CDELT."""
+        projection = ask_first._Projection(
+            '-SIN', 162.75, 30.76, 774.2628174, 575.789917,
+            -5.000000237E-04, 5.000000237E-04)
+        coords = 162.5302917, 30.6770889
+        width = 3 / 60
+
+        def bounds(cdelt1, cdelt2):
+            field = ask_first._Field(
+                None, (2000, 2000),
+                projection._replace(cdelt1=cdelt1, cdelt2=cdelt2),
+                None, 1, 0)
+            return ask_first._pixel_bounds(field, coords, width)
+
+        min_x, max_x, min_y, max_y = bounds(
+            projection.cdelt1, projection.cdelt2)
+        for cdelt1, cdelt2 in [(-projection.cdelt1, projection.cdelt2),
+                               (projection.cdelt1, -projection.cdelt2),
+                               (-projection.cdelt1, -projection.cdelt2)]:
+            flipped = bounds(cdelt1, cdelt2)
+            self.assertLess(flipped[0], flipped[1])
+            self.assertLess(flipped[2], flipped[3])
+            self.assertEqual(flipped[1] - flipped[0], max_x - min_x)
+            self.assertEqual(flipped[3] - flipped[2], max_y - min_y)
+
+
+class TestGetImages(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = ask_first.read_paths(DATA_PATH)
+        ask_first._open_field.cache_clear()
+
+    def test(self):
+        """get_images retrieves images in order."""
+        coords = [(162.5302917, 30.6770889), (162.75, 30.76),
+                  (162.5302917, 30.6770889)]
+        width = 3 / 60
+
+        ims = ask_first.get_images(coords, width, self.paths)
+
+        self.assertEqual(len(ims), 3)
+        reference_im = numpy.load(os.path.join(
+            DATA_PATH,
+            'test_data_162.5302917_30.6770889.npy'))
+        numpy.testing.assert_allclose(reference_im, ims[0])
+        numpy.testing.assert_allclose(reference_im, ims[2])
+        numpy.testing.assert_allclose(
+            ask_first.get_image(coords[1], width, self.paths), ims[1])
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'No fadvise')
+    def test_fields(self):
+        """get_images retrieves images from several fields."""
+        path = os.path.join(DATA_PATH, '10510', '10510+30456E.fits')
+        # Both fields point at the same file.
+        paths = ask_first.PathIndex(
+            [(162.75, 30.76), (163.0, 30.76)], [path, path])
+        coords = [(162.95, 30.7), (162.5302917, 30.6770889), (162.9, 30.8)]
+        width = 3 / 60
+
+        with unittest.mock.patch.object(
+                ask_first, '_prefetch', wraps=ask_first._prefetch) as prefetch:
+            ims = ask_first.get_images(coords, width, paths)
+
+        self.assertEqual(prefetch.call_count, 2)
+        for coord, im in zip(coords, ims):
+            numpy.testing.assert_allclose(
+                ask_first.get_image(coord, width, self.paths), im)
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'No fadvise')
+    def test_prefetch(self):
+        """_prefetch reads ahead only the rows cutouts need."""
+        path = os.path.join(DATA_PATH, '10510', '10510+30456E.fits')
+        coords = numpy.array([(162.5302917, 30.6770889)])
+        width = 3 / 60
+        with unittest.mock.patch('os.posix_fadvise') as fadvise:
+            ask_first._prefetch(path, coords, width)
+
+        (_, offset, length, _), _ = fadvise.call_args
+        # Two header blocks, then rows 359 to 460 of 1550 float32 pixels.
+        self.assertEqual(offset, 2 * 2880 + 359 * 1550 * 4)
+        self.assertEqual(length, 101 * 1550 * 4)
+
+
+class TestReadHeaderValues(unittest.TestCase):
+
+    def test(self):
+        """_read_header_values reads the same values as astropy."""
+        path = os.path.join(DATA_PATH, '10510', '10510+30456E.fits')
+        with open(path, 'rb') as f:
+            values = ask_first._read_header_values(f)
+            self.assertEqual(f.tell(), 2 * 2880)
+        header = astropy.io.fits.getheader(path)
+        for keyword in ['NAXIS1', 'BITPIX', 'CTYPE1', 'CTYPE2', 'CRVAL1',
+                        'CDELT1', 'CRPIX2', 'CROTA2', 'BUNIT', 'EXTEND']:
+            self.assertEqual(values[keyword], header[keyword], keyword)
+        self.assertNotIn('HISTORY', values)
+
+    def test_truncated(self):
+        """_read_header_values rejects a header without an END card."""
+        with tempfile.TemporaryFile() as f:
+            f.write(b'SIMPLE  =                    T'.ljust(2880))
+            f.seek(0)
+            with self.assertRaises(ValueError):
+                ask_first._read_header_values(f)
+
+
+class TestMakeImageTable(unittest.TestCase):
+
+    def test_deprecated(self):
+        """make_image_table is deprecated."""
+        with self.assertWarns(DeprecationWarning):
+            # The table exists, so Montage isn't run.
+            ask_first.make_image_table(
+                DATA_PATH, os.path.join(DATA_PATH, 'img.tbl'))
+
+
 class TestReadCatalogue(unittest.TestCase):
 
     def test(self):